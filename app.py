@@ -1,20 +1,28 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.requests import Request
 import uvicorn
+import aiofiles
 import shutil
 from pathlib import Path
 import zipfile
 import os
+import time
 import asyncio
 import uuid
 import logging
 from typing import List, Dict
 from dotenv import load_dotenv
 
-from proofreader import extract_text, call_grok, save_reports, save_single_report
+import httpx
+from zipstream import ZipStream
+from arq import create_pool
+from arq.connections import RedisSettings
+
+from job_store import create_job_store
+from proofreader import extract_text, call_grok_batch, pack_batches, save_reports, save_single_report
 
 load_dotenv()
 
@@ -25,7 +33,6 @@ logger = logging.getLogger("proofreader.queue")
 
 TEMP_ROOT = Path("/tmp/proofreader")
 TEMP_ROOT.mkdir(parents=True, exist_ok=True)
-JOBS: Dict[str, Dict] = {}
 
 ROLES = {
     "legal": "You are a senior paralegal editor. Ensure legal accuracy, eliminate ambiguity, flag risky language, and maintain formal contract structure. Use precise terminology.",
@@ -36,6 +43,53 @@ ROLES = {
 }
 
 DEFAULT_ROLE = "academic"
+MAX_CONCURRENT_CALLS = 8
+MAX_FILE_BYTES = int(os.getenv("MAX_DOCX_MB", "25")) * 1024 * 1024
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JANITOR_INTERVAL_SECONDS = 300
+
+# Redis-backed when REDIS_URL is set so gunicorn -w N workers share one job table
+store = create_job_store(JOB_TTL_SECONDS)
+
+@app.on_event("startup")
+async def startup():
+    app.state.http = httpx.AsyncClient(
+        timeout=60,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        headers={"Content-Type": "application/json"}
+    )
+    app.state.janitor = asyncio.create_task(_janitor())
+    redis_url = os.getenv("REDIS_URL")
+    app.state.arq = await create_pool(RedisSettings.from_dsn(redis_url)) if redis_url else None
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.janitor.cancel()
+    if app.state.arq:
+        await app.state.arq.aclose()
+    await app.state.http.aclose()
+
+async def _janitor():
+    """Sweep expired job dirs so /tmp stays bounded even if clients never call DELETE."""
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL_SECONDS)
+        now = time.time()
+        for job_dir in TEMP_ROOT.iterdir():
+            if not job_dir.is_dir() or job_dir.name == "llm_cache":
+                continue
+            try:
+                if now - job_dir.stat().st_mtime < JOB_TTL_SECONDS:
+                    continue
+                job = await store.get(job_dir.name)
+                if job and job["status"] not in ("complete", "failed"):
+                    continue
+                logger.info("Janitor expiring job %s", job_dir.name)
+                await cleanup_job(job_dir.name)
+            except Exception:
+                # A dir vanishing mid-sweep or a store hiccup must not kill
+                # the sweeper; whatever is left gets retried next pass.
+                logger.exception("Janitor failed on %s", job_dir.name)
 
 @app.get("/")
 async def home(request: Request):
@@ -63,9 +117,20 @@ async def proofread(
     for file in files:
         if not file.filename.lower().endswith(".docx"):
             continue
+        if file.size and file.size > MAX_FILE_BYTES:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise HTTPException(413, f"{file.filename} exceeds the {MAX_FILE_BYTES >> 20} MB limit")
         path = upload_dir / file.filename
-        with open(path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+        written = 0
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await file.read(1 << 20):
+                written += len(chunk)
+                if written > MAX_FILE_BYTES:
+                    break
+                await f.write(chunk)
+        if written > MAX_FILE_BYTES:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise HTTPException(413, f"{file.filename} exceeds the {MAX_FILE_BYTES >> 20} MB limit")
         docx_paths.append(path)
 
     if not docx_paths:
@@ -82,52 +147,69 @@ async def proofread(
         for idx, path in enumerate(docx_paths)
     ]
 
-    JOBS[job_id] = {
+    job = {
         "status": "queued",
         "files": file_entries,
-        "zip_path": None,
         "error": None,
         "role": role
     }
+    await store.set(job_id, job)
     logger.info("Queued job %s with %d file(s)", job_id, len(docx_paths))
 
-    asyncio.create_task(asyncio.to_thread(process_job, job_id, docx_paths, api_key, role))
+    if app.state.arq:
+        await app.state.arq.enqueue_job("process_job", job_id, [str(p) for p in docx_paths], role)
+    else:
+        asyncio.create_task(process_job(job_id, docx_paths, api_key, role, app.state.http))
 
     return {
         "job_id": job_id,
-        "status": JOBS[job_id]["status"],
-        "files": serialize_job_files(JOBS[job_id])
+        "status": job["status"],
+        "files": serialize_job_files(job)
     }
 
 @app.get("/queue/{job_id}")
 async def queue_status(job_id: str):
-    job = JOBS.get(job_id)
+    job = await store.get(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
     return {
         "job_id": job_id,
         "status": job["status"],
         "files": serialize_job_files(job),
-        "download_ready": bool(job.get("zip_path")),
+        "download_ready": job["status"] == "complete",
         "error": job.get("error")
     }
 
 @app.get("/queue/{job_id}/download")
 async def download_results(job_id: str):
-    job = JOBS.get(job_id)
+    job = await store.get(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
-    if job["status"] != "complete" or not job.get("zip_path"):
+    if job["status"] != "complete":
         raise HTTPException(400, "Job is still processing")
-    return FileResponse(
-        job["zip_path"],
+    output_dir = TEMP_ROOT / job_id / "output"
+    if not output_dir.is_dir():
+        raise HTTPException(404, "Job output missing")
+
+    # Zip on the fly; deflate the text artifacts but don't waste CPU
+    # recompressing .docx entries, which are already deflate inside.
+    zs = ZipStream()
+    for path in sorted(output_dir.iterdir()):
+        if path.suffix == ".docx":
+            zs.add_path(str(path), compress_type=zipfile.ZIP_STORED)
+        else:
+            zs.add_path(str(path), compress_type=zipfile.ZIP_DEFLATED, compress_level=6)
+    return StreamingResponse(
+        zs,
         media_type="application/zip",
-        filename=f"{job_id}_proofread_results.zip"
+        headers={
+            "Content-Disposition": f'attachment; filename="{job_id}_proofread_results.zip"'
+        }
     )
 
 @app.get("/queue/{job_id}/files/{file_id}")
 async def download_single_file(job_id: str, file_id: int):
-    job = JOBS.get(job_id)
+    job = await store.get(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
     try:
@@ -151,14 +233,14 @@ async def download_single_file(job_id: str, file_id: int):
 
 @app.delete("/queue/{job_id}")
 async def delete_job(job_id: str):
-    cleaned = cleanup_job(job_id)
+    cleaned = await cleanup_job(job_id)
     if not cleaned:
         raise HTTPException(404, "Job not found")
     return {"status": "deleted"}
 
 @app.post("/queue/{job_id}/cleanup")
 async def cleanup_job_post(job_id: str):
-    cleanup_job(job_id)
+    await cleanup_job(job_id)
     return {"status": "deleted"}
 
 def serialize_job_files(job: Dict) -> List[Dict]:
@@ -172,59 +254,104 @@ def serialize_job_files(job: Dict) -> List[Dict]:
         for file_info in job["files"]
     ]
 
-def process_job(job_id: str, docx_paths: List[Path], api_key: str, role: str):
-    job = JOBS.get(job_id)
+async def process_job(job_id: str, docx_paths: List[Path], api_key: str, role: str, client: httpx.AsyncClient):
+    job = await store.get(job_id)
     if not job:
         return
 
     temp_dir = TEMP_ROOT / job_id
     output_dir = temp_dir / "output"
     output_dir.mkdir(parents=True, exist_ok=True)
-    results = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
 
     job["status"] = "processing"
-    for idx, path in enumerate(docx_paths):
+    await store.set(job_id, job)
+    try:
+        await _run_job(job, job_id, docx_paths, api_key, role, client, temp_dir, output_dir, semaphore)
+    except Exception as e:
+        logger.exception("Job %s crashed; cleaning up", job_id)
+        job["status"] = "failed"
+        job["error"] = str(e)
+        await store.set(job_id, job)
+        # Remove only the job dir; the store entry stays queryable as
+        # "failed" until the TTL/janitor expires it.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+async def _run_job(job, job_id, docx_paths, api_key, role, client, temp_dir, output_dir, semaphore):
+
+    async def _extract(idx: int, path: Path):
         file_entry = job["files"][idx]
         file_entry["status"] = "processing"
         file_entry["download_url"] = None
         file_entry["report_path"] = None
+        await store.set(job_id, job)
         logger.info("Job %s: processing %s", job_id, path.name)
         try:
-            text = extract_text(path)
-            structured = call_grok(text, api_key, ROLES[role])
-            result_payload = {
+            return await asyncio.to_thread(extract_text, path)
+        except Exception as e:
+            logger.exception("Job %s failed extracting %s", job_id, path.name)
+            return e
+
+    texts = list(await asyncio.gather(*[_extract(idx, path) for idx, path in enumerate(docx_paths)]))
+
+    # Pack small documents into shared Grok requests; failed extractions stay out.
+    readable = [idx for idx, text in enumerate(texts) if not isinstance(texts[idx], Exception)]
+    batches = pack_batches([texts[idx] for idx in readable])
+    structured: List = list(texts)
+
+    async def _call(positions: List[int]):
+        indices = [readable[pos] for pos in positions]
+        async with semaphore:
+            try:
+                datas = await call_grok_batch(client, [texts[idx] for idx in indices], api_key, ROLES[role])
+            except Exception as e:
+                logger.exception("Job %s: Grok call failed for %s", job_id, [docx_paths[i].name for i in indices])
+                datas = [e] * len(indices)
+        for idx, data in zip(indices, datas):
+            structured[idx] = data
+
+    await asyncio.gather(*[_call(positions) for positions in batches])
+
+    async def _finish(idx: int, path: Path) -> Dict:
+        file_entry = job["files"][idx]
+        data = structured[idx]
+        if isinstance(data, Exception):
+            file_entry["status"] = "error"
+            job["error"] = str(data)
+            await store.set(job_id, job)
+            fallback = {"summary": f"Processing failed: {data}", "corrections": []}
+            return {
                 "filename": path.name,
-                "char_count": len(text),
-                "api_result": {"data": structured}
+                "char_count": 0,
+                "api_result": {"data": fallback}
             }
-            results.append(result_payload)
-            report_path = save_single_report(result_payload, output_dir)
+        result_payload = {
+            "filename": path.name,
+            "char_count": len(texts[idx]),
+            "api_result": {"data": data}
+        }
+        try:
+            report_path = await asyncio.to_thread(save_single_report, result_payload, output_dir)
             file_entry["status"] = "complete"
             file_entry["report_path"] = str(report_path)
             file_entry["download_url"] = f"/queue/{job_id}/files/{file_entry['id']}"
         except Exception as e:
-            logger.exception("Job %s failed on %s", job_id, path.name)
+            logger.exception("Job %s failed writing report for %s", job_id, path.name)
             file_entry["status"] = "error"
             job["error"] = str(e)
-            fallback = {"summary": f"Processing failed: {e}", "corrections": []}
-            results.append({
-                "filename": path.name,
-                "char_count": 0,
-                "api_result": {"data": fallback}
-            })
+        await store.set(job_id, job)
+        return result_payload
+
+    results = list(await asyncio.gather(*[_finish(idx, path) for idx, path in enumerate(docx_paths)]))
 
-    save_reports(results, output_dir)
-    zip_path = temp_dir / "proofread_results.zip"
-    with zipfile.ZipFile(zip_path, "w") as zf:
-        for file in output_dir.iterdir():
-            zf.write(file, file.name)
+    await asyncio.to_thread(save_reports, results, output_dir)
 
-    job["zip_path"] = str(zip_path)
     job["status"] = "complete" if not job.get("error") else "failed"
+    await store.set(job_id, job)
     logger.info("Job %s finished with status %s", job_id, job["status"])
 
-def cleanup_job(job_id: str) -> bool:
-    job_present = JOBS.pop(job_id, None) is not None
+async def cleanup_job(job_id: str) -> bool:
+    job_present = await store.pop(job_id) is not None
     job_dir = TEMP_ROOT / job_id
     dir_exists = job_dir.exists()
     if dir_exists:
@@ -233,4 +360,11 @@ def cleanup_job(job_id: str) -> bool:
     return job_present or dir_exists
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1))
+    )
@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# Run with: gunicorn -c gunicorn_conf.py app:app
+# Requires REDIS_URL so all workers share the same job store.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+timeout = 120
@@ -0,0 +1,64 @@
+import json
+import os
+from typing import Dict, Optional
+
+class MemoryJobStore:
+    """Default store for single-process dev runs."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict] = {}
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        return self._jobs.get(job_id)
+
+    async def set(self, job_id: str, job: Dict):
+        self._jobs[job_id] = job
+
+    async def update(self, job_id: str, fields: Dict) -> Optional[Dict]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        return job
+
+    async def pop(self, job_id: str) -> Optional[Dict]:
+        return self._jobs.pop(job_id, None)
+
+class RedisJobStore:
+    """Shared store so every gunicorn/uvicorn worker sees the same job table."""
+
+    def __init__(self, url: str, ttl_seconds: int):
+        from redis.asyncio import Redis
+        self._redis = Redis.from_url(url)
+        self._ttl = ttl_seconds
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"proofreader:job:{job_id}"
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        data = await self._redis.get(self._key(job_id))
+        return json.loads(data) if data else None
+
+    async def set(self, job_id: str, job: Dict):
+        await self._redis.set(self._key(job_id), json.dumps(job), ex=self._ttl)
+
+    async def update(self, job_id: str, fields: Dict) -> Optional[Dict]:
+        job = await self.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        await self.set(job_id, job)
+        return job
+
+    async def pop(self, job_id: str) -> Optional[Dict]:
+        job = await self.get(job_id)
+        if job is not None:
+            await self._redis.delete(self._key(job_id))
+        return job
+
+def create_job_store(ttl_seconds: int):
+    url = os.getenv("REDIS_URL")
+    if url:
+        return RedisJobStore(url, ttl_seconds)
+    return MemoryJobStore()
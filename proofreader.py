@@ -1,66 +1,322 @@
-import json, csv
+import asyncio
+import copy
+import csv
+import hashlib
+import io
+import mmap
+import os
+import zipfile
+from lxml import etree
 from pathlib import Path
 from docx import Document
-import requests
-from typing import List, Dict
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+import httpx
+import orjson
+import tiktoken
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from typing import List, Dict, Optional
 import logging
 
+import cachetools
+import diskcache
+
 DEFAULT_API_URL = "https://api.x.ai/v1/chat/completions"
 DEFAULT_MODEL = "grok-3"
 
-PROMPT = (
-    "Proofread and return ONLY valid JSON: "
-    '{{"corrections": [{{"original": "", "suggested": "", "reason": ""}}], '
-    '"summary": "..."}} Text: """{}"""'
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") not in ("0", "false", "no")
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+_memory_cache = cachetools.LRUCache(maxsize=1024)
+_disk_cache = diskcache.Cache("/tmp/proofreader/llm_cache")
+
+# Static instruction blocks; the document text is sent as a separate trailing
+# user message so the byte-identical prefix stays eligible for provider prompt
+# caching across calls.
+INSTRUCTION = (
+    "Proofread the user's text and return ONLY valid JSON: "
+    '{"corrections": [{"original": "", "suggested": "", "reason": ""}], '
+    '"summary": "..."}'
 )
 
+BATCH_INSTRUCTION = (
+    "Proofread each document in the user's message and return ONLY valid JSON: "
+    '{"results": [{"index": 0, "corrections": [{"original": "", "suggested": "", "reason": ""}], '
+    '"summary": "..."}]} with one entry per document, keyed by its index. '
+    "Documents are delimited by <<<DOC i>>> markers."
+)
+
+BATCH_TOKEN_BUDGET = 80_000
+MAX_DOC_TOKENS = 12_000
+
+_encoding = None
+
+def _get_encoding():
+    # Lazy: tiktoken fetches the BPE ranks on first use.
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+def _chunk(text: str, max_tokens: int = MAX_DOC_TOKENS) -> List[str]:
+    """Split text on paragraph boundaries into chunks of at most max_tokens.
+
+    A single paragraph longer than max_tokens is hard-split at the token
+    level; every returned chunk is guaranteed to fit the budget.
+    """
+    enc = _get_encoding()
+    chunks = []
+    current = []
+    used = 0
+    for para in text.split("\n"):
+        tokens = enc.encode(para)
+        if len(tokens) > max_tokens:
+            if current:
+                chunks.append("\n".join(current))
+                current = []
+                used = 0
+            for start in range(0, len(tokens), max_tokens):
+                chunks.append(enc.decode(tokens[start:start + max_tokens]))
+            continue
+        cost = len(tokens) + 1
+        if current and used + cost > max_tokens:
+            chunks.append("\n".join(current))
+            current = []
+            used = 0
+        current.append(para)
+        used += cost
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
 logger = logging.getLogger("proofreader")
 if not logger.handlers:
     logging.basicConfig(level=logging.INFO)
 
+def _cache_key(model: str, system_prompt: str, text: str) -> str:
+    return hashlib.sha256(f"{model}|{system_prompt}|{text}".encode()).hexdigest()
+
+def _cache_get(key: str) -> Optional[Dict]:
+    if not CACHE_ENABLED:
+        return None
+    cached = _memory_cache.get(key)
+    if cached is None:
+        cached = _disk_cache.get(key)
+        if cached is not None:
+            _memory_cache[key] = cached
+    if cached is not None:
+        logger.info("Cache hit for key %s", key[:12])
+    return cached
+
+def _cache_put(key: str, content: Dict):
+    if not CACHE_ENABLED:
+        return
+    _memory_cache[key] = content
+    _disk_cache.set(key, content, expire=CACHE_TTL_SECONDS)
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+class _MmapReader(io.RawIOBase):
+    """Seekable file wrapper over an mmap; mmap itself lacks the io protocol."""
+
+    def __init__(self, mm: mmap.mmap):
+        self._mm = mm
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._mm.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        self._mm.seek(pos, whence)
+        return self._mm.tell()
+
+    def tell(self) -> int:
+        return self._mm.tell()
+
 def extract_text(path: Path) -> str:
-    return "\n".join(p.text for p in Document(path).paragraphs if p.text.strip())
+    """Pull paragraph text straight out of word/document.xml.
+
+    Loading the full python-docx object model (styles, sections, every
+    run) just to read text is far slower than streaming the XML. The
+    archive is memory-mapped so concurrent extractions share kernel
+    page-cache pages instead of each holding a private copy in RAM.
+    """
+    paras = []
+    buf = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        with zipfile.ZipFile(_MmapReader(mm)) as z, z.open("word/document.xml") as f:
+            for _, el in etree.iterparse(f, events=("end",), tag=(_W_NS + "t", _W_NS + "p")):
+                if el.tag == _W_NS + "t":
+                    buf.append(el.text or "")
+                else:
+                    paras.append("".join(buf))
+                    buf.clear()
+                el.clear()
+    finally:
+        mm.close()
+    return "\n".join(p for p in paras if p.strip())
 
-def call_grok(text: str, api_key: str, system_prompt: str, api_url=DEFAULT_API_URL, model=DEFAULT_MODEL):
-    user_prompt = PROMPT.format(text)
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+def _retry_wait(retry_state):
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return wait_exponential_jitter(initial=1, max=30)(retry_state)
+
+@retry(stop=stop_after_attempt(5), wait=_retry_wait, retry=retry_if_exception(_is_retryable), reraise=True)
+async def _post_grok(client: httpx.AsyncClient, payload: Dict, api_key: str, api_url: str) -> Dict:
+    resp = await client.post(
+        api_url,
+        headers={"Authorization": f"Bearer {api_key}"},
+        content=orjson.dumps(payload)
+    )
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+async def call_grok(client: httpx.AsyncClient, text: str, api_key: str, system_prompt: str, api_url=DEFAULT_API_URL, model=DEFAULT_MODEL):
+    key = _cache_key(model, system_prompt, text)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    if len(_get_encoding().encode(text)) > MAX_DOC_TOKENS:
+        chunks = _chunk(text)
+        # Guard against recursing on identical input if splitting got us nowhere.
+        if len(chunks) > 1:
+            logger.info("Splitting document into %d chunks to fit the context window", len(chunks))
+            parts = await asyncio.gather(
+                *[call_grok(client, chunk, api_key, system_prompt, api_url, model) for chunk in chunks]
+            )
+            structured = {
+                "corrections": sum((p.get("corrections", []) for p in parts), []),
+                "summary": " ".join(p.get("summary", "") for p in parts).strip()
+            }
+            _cache_put(key, structured)
+            return structured
     logger.info(
-        "Dispatching Grok request with system prompt:\n%s\nUser prompt:\n%s",
+        "Dispatching Grok request with system prompt:\n%s\nText:\n%s",
         system_prompt,
-        user_prompt,
+        text,
     )
     payload = {
         "model": model,
         "messages": [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
+            {"role": "system", "content": INSTRUCTION},
+            {"role": "user", "content": text}
         ]
     }
-    resp = requests.post(
-        api_url,
-        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        json=payload,
-        timeout=60
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = await _post_grok(client, payload, api_key, api_url)
     content = data["choices"][0]["message"]["content"]
-    return json.loads(content)
+    structured = orjson.loads(content)
+    _cache_put(key, structured)
+    return structured
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+def pack_batches(texts: List[str], budget: int = BATCH_TOKEN_BUDGET) -> List[List[int]]:
+    """Greedy-pack document positions into batches under the token budget."""
+    batches = []
+    current = []
+    used = 0
+    for pos, text in enumerate(texts):
+        cost = estimate_tokens(text)
+        if current and used + cost > budget:
+            batches.append(current)
+            current = []
+            used = 0
+        current.append(pos)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+async def call_grok_batch(client: httpx.AsyncClient, texts: List[str], api_key: str, system_prompt: str, api_url=DEFAULT_API_URL, model=DEFAULT_MODEL) -> List[Dict]:
+    """Proofread several documents in one request, returning one dict per input."""
+    if len(texts) == 1:
+        return [await call_grok(client, texts[0], api_key, system_prompt, api_url, model)]
+    docs = "\n".join(f"<<<DOC {i}>>>\n{t}" for i, t in enumerate(texts))
+    key = _cache_key(model, system_prompt, docs)
+    parsed = _cache_get(key)
+    if parsed is None:
+        logger.info("Dispatching batched Grok request for %d document(s)", len(texts))
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": BATCH_INSTRUCTION},
+                {"role": "user", "content": docs}
+            ]
+        }
+        data = await _post_grok(client, payload, api_key, api_url)
+        content = data["choices"][0]["message"]["content"]
+        parsed = orjson.loads(content)
+        _cache_put(key, parsed)
+    by_index = {r.get("index"): r for r in parsed.get("results", [])}
+    return [
+        {
+            "corrections": by_index.get(i, {}).get("corrections", []),
+            "summary": by_index.get(i, {}).get("summary", "")
+        }
+        for i in range(len(texts))
+    ]
+
+# Resolve the table style once; looking it up by name walks styles.xml on
+# every add_table call otherwise. New reports are cloned from this template.
+_TEMPLATE = Document()
+_TABLE_STYLE = _TEMPLATE.styles["Table Grid"]
+
+def _blank_document():
+    return copy.deepcopy(_TEMPLATE)
+
+def _make_row(texts: List[str]):
+    """Build a <w:tr> directly; add_row() re-walks the table XML per call."""
+    tr = OxmlElement("w:tr")
+    for value in texts:
+        tc = OxmlElement("w:tc")
+        p = OxmlElement("w:p")
+        r = OxmlElement("w:r")
+        t = OxmlElement("w:t")
+        t.text = value
+        t.set(qn("xml:space"), "preserve")
+        r.append(t)
+        p.append(r)
+        tc.append(p)
+        tr.append(tc)
+    return tr
 
 def build_table(doc, corrections):
-    table = doc.add_table(rows=1, cols=3, style="Table Grid")
+    table = doc.add_table(rows=1, cols=3, style=_TABLE_STYLE)
     for i, label in enumerate(["Original", "Suggested", "Reason"]):
         table.rows[0].cells[i].text = label
         table.rows[0].cells[i].paragraphs[0].runs[0].bold = True
-    for c in corrections:
-        row = table.add_row().cells
-        row[0].text = c.get("original", "")
-        row[1].text = c.get("suggested", "")
-        row[2].text = c.get("reason", "")
+    table._tbl.extend(
+        _make_row([c.get("original", ""), c.get("suggested", ""), c.get("reason", "")])
+        for c in corrections
+    )
 
 def save_single_report(result: Dict, out_dir: Path) -> Path:
     out_dir.mkdir(parents=True, exist_ok=True)
     data = result["api_result"]["data"]
-    doc = Document()
+    doc = _blank_document()
     doc.add_heading(f"Proofreading: {result['filename']}", 0)
     doc.add_paragraph(f"Summary: {data.get('summary', '')}")
     build_table(doc, data.get("corrections", []))
@@ -69,29 +325,28 @@ def save_single_report(result: Dict, out_dir: Path) -> Path:
     return report_path
 
 def save_reports(results: List[Dict], out_dir: Path):
+    """Emit results.json, summary.csv and the master DOCX.
+
+    Per-file reports are not written here; save_single_report already
+    produced them as each file finished.
+    """
     out_dir.mkdir(parents=True, exist_ok=True)
-    
-    # JSON + CSV
-    (out_dir / "results.json").write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    (out_dir / "results.json").write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    # One pass over results: each entry feeds its CSV row and its
+    # master-doc section together.
+    master = _blank_document()
+    master.add_heading("Grok Proofreading Report", 0)
     with (out_dir / "summary.csv").open("w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["filename", "status", "correction_count", "summary"])
         for r in results:
             d = r["api_result"]["data"]
             w.writerow([r["filename"], "proofread", len(d.get("corrections", [])), d.get("summary", "")])
-    
-    # Master DOCX
-    master = Document()
-    master.add_heading("Grok Proofreading Report", 0)
-    for r in results:
-        d = r["api_result"]["data"]
-        master.add_heading(r["filename"], 1)
-        master.add_paragraph(f"Characters: {r['char_count']}")
-        master.add_paragraph(f"Summary: {d.get('summary', '')}")
-        build_table(master, d.get("corrections", []))
-        master.add_page_break()
+            master.add_heading(r["filename"], 1)
+            master.add_paragraph(f"Characters: {r['char_count']}")
+            master.add_paragraph(f"Summary: {d.get('summary', '')}")
+            build_table(master, d.get("corrections", []))
+            master.add_page_break()
     master.save(out_dir / "PROOFREADING_REPORT.docx")
-    
-    # Per-file DOCX
-    for r in results:
-        save_single_report(r, out_dir)
@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+# Run the arq worker alongside gunicorn in the same container: jobs hand
+# uploads and reports between web and worker through /tmp/proofreader, so
+# the two must share a filesystem.
+set -e
+arq worker.WorkerSettings &
+exec gunicorn -c gunicorn_conf.py app:app
@@ -0,0 +1,37 @@
+"""arq worker that runs proofreading jobs outside the web process.
+
+Start with `arq worker.WorkerSettings`. Requires REDIS_URL (shared with
+the web app so job state is visible to both) and GROK_API_KEY in the
+worker's environment.
+"""
+import os
+
+from pathlib import Path
+import httpx
+from arq.connections import RedisSettings
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import process_job as _process_job
+
+async def startup(ctx):
+    ctx["http"] = httpx.AsyncClient(
+        timeout=60,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        headers={"Content-Type": "application/json"}
+    )
+    ctx["api_key"] = os.getenv("GROK_API_KEY")
+
+async def shutdown(ctx):
+    await ctx["http"].aclose()
+
+async def process_job(ctx, job_id: str, docx_paths: list, role: str):
+    await _process_job(job_id, [Path(p) for p in docx_paths], ctx["api_key"], role, ctx["http"])
+
+class WorkerSettings:
+    functions = [process_job]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(os.getenv("REDIS_URL", "redis://localhost:6379"))